@@ -4,19 +4,28 @@ Provides REST API for Segment Anything Model (SAM)
 """
 
 import os
-import base64
 import io
 import logging
 from typing import Optional, List
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from PIL import Image
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 import numpy as np
 from dotenv import load_dotenv
 
+from memory import MemoryBudget, MemoryBudgetExceeded, PeakRSS, MB
+from payload import EncodedImage, PayloadError, read_segment_request, stream_segment_response, json_body
+from postprocess import postprocess_mask
 from sam_model import SAMModel
+from scheduler import (
+    PriorityScheduler,
+    QueueFullError,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_BATCH,
+)
 
 # Load environment variables
 load_dotenv()
@@ -29,6 +38,25 @@ SAM_CHECKPOINT = os.getenv("SAM_CHECKPOINT", "mobile_sam.pt")
 DEVICE = os.getenv("DEVICE", "auto")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
+# Tiled high-resolution segmentation
+TILE_SIZE = int(os.getenv("TILE_SIZE", 1024))
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", 128))
+TILED_AUTO_MIN_SIDE = int(os.getenv("TILED_AUTO_MIN_SIDE", 0))  # 0 = only when requested
+
+# Request limits and memory budget
+MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", 100))  # Compressed image size
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 100_000_000))  # 0 = unlimited
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", 2048))  # 0 = unlimited
+
+# Scheduler configuration
+INTERACTIVE_MAX_QUEUE = int(os.getenv("INTERACTIVE_MAX_QUEUE", 16))
+BATCH_MAX_QUEUE = int(os.getenv("BATCH_MAX_QUEUE", 256))
+INTERACTIVE_MAX_PER_TENANT = int(os.getenv("INTERACTIVE_MAX_PER_TENANT", 4))  # 0 = class limit
+BATCH_MAX_PER_TENANT = int(os.getenv("BATCH_MAX_PER_TENANT", 64))  # 0 = class limit
+BATCH_DEFER_MS = int(os.getenv("BATCH_DEFER_MS", 50))
+PRIORITY_HEADER = "X-SAM-Priority"
+TENANT_HEADER = "X-Tenant-Id"
+
 # Setup logging
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
@@ -55,23 +83,59 @@ app.add_middleware(
 # Global SAM model instance
 sam_model: Optional[SAMModel] = None
 
+# Global scheduler, all inference goes through it
+scheduler = PriorityScheduler(
+    max_queue_depth={
+        PRIORITY_INTERACTIVE: INTERACTIVE_MAX_QUEUE,
+        PRIORITY_BATCH: BATCH_MAX_QUEUE,
+    },
+    batch_defer_ms=BATCH_DEFER_MS,
+    max_tenant_depth={
+        PRIORITY_INTERACTIVE: INTERACTIVE_MAX_PER_TENANT,
+        PRIORITY_BATCH: BATCH_MAX_PER_TENANT,
+    }
+)
+
+# Memory reserved by in-flight requests, checked before they are admitted
+memory_budget = MemoryBudget(MEMORY_BUDGET_MB * MB)
+
 
 # Request/Response models
+class MaskPostprocess(BaseModel):
+    dilate: int = Field(0, ge=-128, le=128)  # Grow radius in px, negative erodes
+    fillHoles: bool = False  # Fill enclosed background regions
+    minArea: int = Field(0, ge=0)  # Remove regions smaller than this many px
+    feather: int = Field(0, ge=0, le=128)  # Soft edge width in px
+    alpha: bool = False  # Alpha matte from the mask logits instead of a binary mask
+
+
 class SegmentPointRequest(BaseModel):
     image: str  # Base64 encoded image
     point: List[int]  # [x, y]
     objectPrompt: Optional[str] = None  # For future use
+    tiled: Optional[bool] = None  # Tiled high-resolution mode, None = auto by image size
+    postprocess: Optional[MaskPostprocess] = None  # Applied before encoding
+    priority: Optional[str] = None  # interactive | batch, overrides X-SAM-Priority
+    tenantId: Optional[str] = None  # Overrides X-Tenant-Id
 
 
 class SegmentPointsRequest(BaseModel):
     image: str
     points: List[List[int]]  # [[x1, y1], [x2, y2], ...]
     objectPrompt: Optional[str] = None
+    tiled: Optional[bool] = None
+    postprocess: Optional[MaskPostprocess] = None
+    priority: Optional[str] = None
+    tenantId: Optional[str] = None
 
 
 class SegmentBoxRequest(BaseModel):
     image: str
     box: List[int]  # [x1, y1, x2, y2]
+    tiled: Optional[bool] = None
+    postprocess: Optional[MaskPostprocess] = None
+    priority: Optional[str] = None
+    tenantId: Optional[str] = None
 
 
 class SegmentResponse(BaseModel):
@@ -79,50 +143,140 @@ class SegmentResponse(BaseModel):
     maskBase64: Optional[str] = None
     confidence: Optional[float] = None
     message: Optional[str] = None
+    peakRssMb: Optional[float] = None  # Estimated peak memory this request added, None if unavailable
 
 
 # Utility functions
-def base64_to_image(base64_str: str) -> np.ndarray:
-    """Convert base64 string to numpy array"""
+def mask_to_png(mask: np.ndarray) -> memoryview:
+    """Convert mask to PNG bytes"""
     try:
-        # Remove data URL prefix if present
-        if ',' in base64_str:
-            base64_str = base64_str.split(',')[1]
+        # Convert mask to image
+        mask_image = sam_model.mask_to_image(mask)
 
-        # Decode base64
-        image_data = base64.b64decode(base64_str)
+        # Encode without copying the result out of the buffer
+        buffered = io.BytesIO()
+        mask_image.save(buffered, format="PNG")
+        mask_image.close()
 
-        # Open image
-        image = Image.open(io.BytesIO(image_data))
+        return buffered.getbuffer()
 
-        # Convert to RGB if needed
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+    except Exception as e:
+        logger.error(f"Failed to encode mask: {e}")
+        raise
 
-        # Convert to numpy array
-        return np.array(image)
 
-    except Exception as e:
-        logger.error(f"Failed to decode base64 image: {e}")
-        raise HTTPException(status_code=400, detail="Invalid image format")
+def use_alpha(request: BaseModel) -> bool:
+    """Whether the request wants an alpha matte instead of a binary mask"""
+    return request.postprocess is not None and request.postprocess.alpha
+
 
+def apply_postprocess(request: BaseModel, mask: np.ndarray) -> np.ndarray:
+    """Run requested post-processing on the predictor mask before encoding"""
+    options = request.postprocess
+    if options is None:
+        return mask
+
+    return postprocess_mask(
+        mask,
+        dilate=options.dilate,
+        fill_holes=options.fillHoles,
+        min_area=options.minArea,
+        feather=options.feather
+    )
 
-def mask_to_base64(mask: np.ndarray) -> str:
-    """Convert mask to base64 string"""
+
+async def read_request(http_request: Request, model, reservation):
+    """Stream the request body, rejecting oversized or over-budget payloads early"""
     try:
-        # Convert mask to image
-        mask_image = sam_model.mask_to_image(mask)
+        return await read_segment_request(
+            http_request,
+            model,
+            reservation,
+            max_image_bytes=MAX_FILE_SIZE_MB * MB,
+            max_pixels=MAX_IMAGE_PIXELS
+        )
+    except PayloadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except RequestValidationError as e:
+        raise HTTPException(status_code=422, detail=jsonable_encoder(e.errors()))
+    except MemoryBudgetExceeded as e:
+        logger.warning(f"Rejected request: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+
+def segment_response(mask_png: memoryview, confidence: float, message: str, peak_rss_mb) -> StreamingResponse:
+    """Stream the SegmentResponse so the base64 mask is never held as one string"""
+    return StreamingResponse(
+        stream_segment_response(
+            mask_png,
+            success=True,
+            confidence=confidence,
+            message=message,
+            peakRssMb=peak_rss_mb
+        ),
+        media_type="application/json"
+    )
 
-        # Convert to base64
-        buffered = io.BytesIO()
-        mask_image.save(buffered, format="PNG")
-        mask_base64 = base64.b64encode(buffered.getvalue()).decode()
 
-        return f"data:image/png;base64,{mask_base64}"
+def use_tiled(request: BaseModel, width: int, height: int) -> bool:
+    """Decide whether to run tiled high-resolution segmentation"""
+    if request.tiled is not None:
+        return request.tiled
 
-    except Exception as e:
-        logger.error(f"Failed to convert mask to base64: {e}")
-        raise
+    return TILED_AUTO_MIN_SIDE > 0 and max(width, height) >= TILED_AUTO_MIN_SIDE
+
+
+async def run_scheduled(request: BaseModel, http_request: Request, job, image: EncodedImage,
+                        tiled: bool = False):
+    """
+    Run a blocking segmentation job through the priority scheduler
+
+    Priority and tenant come from the request body, falling back to the
+    X-SAM-Priority / X-Tenant-Id headers. Tiled jobs default to the batch
+    class since they run many encoder passes.
+
+    While queued, a request holds only its compressed upload in the memory
+    budget. The decoded image and mask are reserved when the job starts on
+    the worker and released when it ends, so a batch backlog cannot use up
+    the budget and turn interactive requests away. The upload is counted in
+    the reported peak.
+
+    Returns:
+        (job result, estimated peak memory of the request in MB or None)
+    """
+    try:
+        priority = scheduler.normalize_priority(
+            request.priority
+            or http_request.headers.get(PRIORITY_HEADER)
+            or (PRIORITY_BATCH if tiled else None)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    tenant = request.tenantId or http_request.headers.get(TENANT_HEADER)
+
+    def measured_job():
+        with memory_budget.reservation() as working:
+            working.add(image.working_bytes)
+            with PeakRSS(baseline_bytes=image.nbytes) as rss:
+                result = job()
+        return result, rss.peak_mb
+
+    try:
+        result, peak_rss_mb = await scheduler.submit(measured_job, priority=priority, tenant=tenant)
+    except QueueFullError as e:
+        logger.warning(f"Rejected request from tenant {tenant}: {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    except PayloadError as e:
+        # Raised on the worker when the image turns out to be undecodable
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except MemoryBudgetExceeded as e:
+        logger.warning(f"Rejected request from tenant {tenant}: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    if peak_rss_mb is not None:
+        logger.info(f"Peak memory {peak_rss_mb} MB ({priority}, tenant {tenant})")
+    return result, peak_rss_mb
 
 
 # API Endpoints
@@ -139,9 +293,13 @@ async def startup_event():
         sam_model = SAMModel(
             model_type=SAM_MODEL,
             checkpoint_path=SAM_CHECKPOINT,
-            device=DEVICE
+            device=DEVICE,
+            tile_size=TILE_SIZE,
+            tile_overlap=TILE_OVERLAP
         )
 
+        scheduler.start()
+
         logger.info("✅ SAM Service ready!")
 
     except Exception as e:
@@ -149,6 +307,12 @@ async def startup_event():
         raise
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the scheduler worker"""
+    await scheduler.stop()
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -170,12 +334,14 @@ async def health_check():
     return {
         "status": "healthy",
         "model": SAM_MODEL,
-        "device": sam_model.device
+        "device": sam_model.device,
+        "queues": scheduler.stats(),
+        "memory": memory_budget.stats()
     }
 
 
-@app.post("/segment/point", response_model=SegmentResponse)
-async def segment_by_point(request: SegmentPointRequest):
+@app.post("/segment/point", response_model=SegmentResponse, openapi_extra=json_body(SegmentPointRequest))
+async def segment_by_point(http_request: Request):
     """
     Segment object by single point click
 
@@ -183,6 +349,10 @@ async def segment_by_point(request: SegmentPointRequest):
         image: Base64 encoded image
         point: [x, y] coordinates
         objectPrompt: Optional hint for object type
+        tiled: Optional tiled high-resolution mode for large images
+        postprocess: Optional mask post-processing (dilate, fillHoles, minArea, feather, alpha)
+        priority: Optional priority class (interactive, batch)
+        tenantId: Optional tenant for fair queueing
 
     Returns:
         Mask as base64 encoded PNG image
@@ -191,26 +361,41 @@ async def segment_by_point(request: SegmentPointRequest):
         if sam_model is None or not sam_model.is_ready():
             raise HTTPException(status_code=503, detail="SAM model not ready")
 
-        logger.info(f"Segmenting by point: {request.point}")
-
-        # Convert base64 to image
-        image_np = base64_to_image(request.image)
-
-        # Segment
-        mask, confidence = sam_model.segment_by_point(
-            image_np,
-            point=tuple(request.point)
-        )
-
-        # Convert mask to base64
-        mask_base64 = mask_to_base64(mask)
-
-        return SegmentResponse(
-            success=True,
-            maskBase64=mask_base64,
-            confidence=confidence,
-            message="Segmentation successful"
-        )
+        with memory_budget.reservation() as reservation:
+            request, image = await read_request(http_request, SegmentPointRequest, reservation)
+
+            tiled = use_tiled(request, image.width, image.height)
+            logger.info(f"Segmenting by point: {request.point}")
+
+            def job():
+                # Decode image, releasing the compressed bytes
+                image_np = image.decode()
+
+                # Segment
+                if tiled:
+                    mask, confidence = sam_model.segment_tiled(
+                        image_np,
+                        points=[request.point],
+                        soft=use_alpha(request),
+                        on_tile=scheduler.checkpoint
+                    )
+                else:
+                    mask, confidence = sam_model.segment_by_point(
+                        image_np,
+                        point=tuple(request.point),
+                        soft=use_alpha(request)
+                    )
+                del image_np
+
+                # Post-process and convert mask to PNG
+                mask = apply_postprocess(request, mask)
+                return mask_to_png(mask), confidence
+
+            (mask_png, confidence), peak_rss_mb = await run_scheduled(
+                request, http_request, job, image, tiled
+            )
+
+        return segment_response(mask_png, confidence, "Segmentation successful", peak_rss_mb)
 
     except HTTPException:
         raise
@@ -219,8 +404,8 @@ async def segment_by_point(request: SegmentPointRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/segment/points", response_model=SegmentResponse)
-async def segment_by_points(request: SegmentPointsRequest):
+@app.post("/segment/points", response_model=SegmentResponse, openapi_extra=json_body(SegmentPointsRequest))
+async def segment_by_points(http_request: Request):
     """
     Segment object by multiple points
 
@@ -228,6 +413,10 @@ async def segment_by_points(request: SegmentPointsRequest):
         image: Base64 encoded image
         points: [[x1, y1], [x2, y2], ...] coordinates
         objectPrompt: Optional hint for object type
+        tiled: Optional tiled high-resolution mode for large images
+        postprocess: Optional mask post-processing (dilate, fillHoles, minArea, feather, alpha)
+        priority: Optional priority class (interactive, batch)
+        tenantId: Optional tenant for fair queueing
 
     Returns:
         Merged mask as base64 encoded PNG image
@@ -236,26 +425,41 @@ async def segment_by_points(request: SegmentPointsRequest):
         if sam_model is None or not sam_model.is_ready():
             raise HTTPException(status_code=503, detail="SAM model not ready")
 
-        logger.info(f"Segmenting by {len(request.points)} points")
-
-        # Convert base64 to image
-        image_np = base64_to_image(request.image)
-
-        # Segment
-        mask, confidence = sam_model.segment_by_points(
-            image_np,
-            points=request.points
-        )
-
-        # Convert mask to base64
-        mask_base64 = mask_to_base64(mask)
-
-        return SegmentResponse(
-            success=True,
-            maskBase64=mask_base64,
-            confidence=confidence,
-            message="Multi-point segmentation successful"
-        )
+        with memory_budget.reservation() as reservation:
+            request, image = await read_request(http_request, SegmentPointsRequest, reservation)
+
+            tiled = use_tiled(request, image.width, image.height)
+            logger.info(f"Segmenting by {len(request.points)} points")
+
+            def job():
+                # Decode image, releasing the compressed bytes
+                image_np = image.decode()
+
+                # Segment
+                if tiled:
+                    mask, confidence = sam_model.segment_tiled(
+                        image_np,
+                        points=request.points,
+                        soft=use_alpha(request),
+                        on_tile=scheduler.checkpoint
+                    )
+                else:
+                    mask, confidence = sam_model.segment_by_points(
+                        image_np,
+                        points=request.points,
+                        soft=use_alpha(request)
+                    )
+                del image_np
+
+                # Post-process and convert mask to PNG
+                mask = apply_postprocess(request, mask)
+                return mask_to_png(mask), confidence
+
+            (mask_png, confidence), peak_rss_mb = await run_scheduled(
+                request, http_request, job, image, tiled
+            )
+
+        return segment_response(mask_png, confidence, "Multi-point segmentation successful", peak_rss_mb)
 
     except HTTPException:
         raise
@@ -264,14 +468,18 @@ async def segment_by_points(request: SegmentPointsRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/segment/box", response_model=SegmentResponse)
-async def segment_by_box(request: SegmentBoxRequest):
+@app.post("/segment/box", response_model=SegmentResponse, openapi_extra=json_body(SegmentBoxRequest))
+async def segment_by_box(http_request: Request):
     """
     Segment object by bounding box
 
     Args:
         image: Base64 encoded image
         box: [x1, y1, x2, y2] coordinates
+        tiled: Optional tiled high-resolution mode for large images
+        postprocess: Optional mask post-processing (dilate, fillHoles, minArea, feather, alpha)
+        priority: Optional priority class (interactive, batch)
+        tenantId: Optional tenant for fair queueing
 
     Returns:
         Mask as base64 encoded PNG image
@@ -280,26 +488,41 @@ async def segment_by_box(request: SegmentBoxRequest):
         if sam_model is None or not sam_model.is_ready():
             raise HTTPException(status_code=503, detail="SAM model not ready")
 
-        logger.info(f"Segmenting by box: {request.box}")
-
-        # Convert base64 to image
-        image_np = base64_to_image(request.image)
-
-        # Segment
-        mask, confidence = sam_model.segment_by_box(
-            image_np,
-            box=tuple(request.box)
-        )
-
-        # Convert mask to base64
-        mask_base64 = mask_to_base64(mask)
-
-        return SegmentResponse(
-            success=True,
-            maskBase64=mask_base64,
-            confidence=confidence,
-            message="Box segmentation successful"
-        )
+        with memory_budget.reservation() as reservation:
+            request, image = await read_request(http_request, SegmentBoxRequest, reservation)
+
+            tiled = use_tiled(request, image.width, image.height)
+            logger.info(f"Segmenting by box: {request.box}")
+
+            def job():
+                # Decode image, releasing the compressed bytes
+                image_np = image.decode()
+
+                # Segment
+                if tiled:
+                    mask, confidence = sam_model.segment_tiled(
+                        image_np,
+                        box=tuple(request.box),
+                        soft=use_alpha(request),
+                        on_tile=scheduler.checkpoint
+                    )
+                else:
+                    mask, confidence = sam_model.segment_by_box(
+                        image_np,
+                        box=tuple(request.box),
+                        soft=use_alpha(request)
+                    )
+                del image_np
+
+                # Post-process and convert mask to PNG
+                mask = apply_postprocess(request, mask)
+                return mask_to_png(mask), confidence
+
+            (mask_png, confidence), peak_rss_mb = await run_scheduled(
+                request, http_request, job, image, tiled
+            )
+
+        return segment_response(mask_png, confidence, "Box segmentation successful", peak_rss_mb)
 
     except HTTPException:
         raise
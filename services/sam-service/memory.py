@@ -0,0 +1,180 @@
+"""
+Memory Accounting
+Per-process memory budget for admission control and per-request peak memory
+"""
+
+import logging
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a reservation would exceed the process memory budget"""
+
+    def __init__(self, requested: int, used: int, limit: int):
+        self.requested = requested
+        self.used = used
+        self.limit = limit
+        super().__init__(
+            f"Memory budget exhausted: {requested / MB:.1f} MB requested, "
+            f"{used / MB:.1f} of {limit / MB:.1f} MB in use"
+        )
+
+
+class MemoryBudget:
+    def __init__(self, limit_bytes: int):
+        """
+        Initialize memory budget
+
+        Args:
+            limit_bytes: Total bytes that in-flight requests may reserve (0 = unlimited)
+        """
+        self.limit = limit_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int):
+        """
+        Reserve bytes from the budget
+
+        Raises:
+            MemoryBudgetExceeded: If the reservation does not fit
+        """
+        with self._lock:
+            if self.limit and self.used + nbytes > self.limit:
+                raise MemoryBudgetExceeded(nbytes, self.used, self.limit)
+            self.used += nbytes
+
+    def release(self, nbytes: int):
+        """Return bytes to the budget"""
+        with self._lock:
+            self.used -= nbytes
+
+    def reservation(self) -> "Reservation":
+        """Create a reservation that is released as a whole when closed"""
+        return Reservation(self)
+
+    def stats(self) -> dict:
+        """Current budget usage in MB"""
+        return {
+            "usedMb": round(self.used / MB, 1),
+            "limitMb": round(self.limit / MB, 1) if self.limit else None,
+        }
+
+
+class Reservation:
+    """Bytes reserved for a single request, grown as its size becomes known"""
+
+    def __init__(self, budget: MemoryBudget):
+        self.budget = budget
+        self.nbytes = 0
+
+    def add(self, nbytes: int):
+        """Grow the reservation, raising MemoryBudgetExceeded if it does not fit"""
+        self.budget.reserve(nbytes)
+        self.nbytes += nbytes
+
+    def close(self):
+        """Release everything reserved so far"""
+        if self.nbytes:
+            self.budget.release(self.nbytes)
+            self.nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _read_status(field: str) -> Optional[int]:
+    """A memory field from /proc/self/status in bytes (Linux only)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_hwm() -> bool:
+    """Reset the peak RSS counter (VmHWM) to the current RSS (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# Measurements in progress on the worker thread, innermost last
+_active: List["PeakRSS"] = []
+
+
+class PeakRSS:
+    """
+    Estimate the peak memory a request adds to the process
+
+    The result is the growth of RSS over its value when the block started
+    (reset VmHWM on entry, read it on exit), plus baseline_bytes that the
+    request already held before the block. The ingest phase keeps the
+    compressed upload resident, so passing its size there covers ingest as
+    well. The model weights and other requests' memory held before the
+    block are excluded. Other requests' bodies being streamed on the event
+    loop while the block runs can still show up in the growth, so treat the
+    value as an upper estimate.
+
+    Blocks may nest (interactive jobs run between tiles of a tiled job). The
+    outer block keeps the peak it saw before the inner one started, and the
+    counter is reset again after the inner block so the inner peak is not
+    counted twice.
+
+    Where VmHWM cannot be reset (non-Linux, restricted /proc) peak_bytes is
+    None. The process-lifetime peak says nothing about a single request.
+    """
+
+    def __init__(self, baseline_bytes: int = 0):
+        self.baseline_bytes = baseline_bytes
+        self.peak_bytes: Optional[int] = None
+        self._start: Optional[int] = None
+        self._high = 0
+
+    def _fold(self):
+        """Record the high-water mark seen so far"""
+        hwm = _read_status("VmHWM")
+        if hwm is not None:
+            self._high = max(self._high, hwm)
+
+    def __enter__(self):
+        if _active:
+            _active[-1]._fold()
+
+        start = _read_status("VmRSS")
+        if start is not None and _reset_hwm():
+            self._start = start
+            self._high = start
+
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _active.pop()
+
+        if self._start is not None:
+            self._fold()
+            self.peak_bytes = self.baseline_bytes + max(self._high - self._start, 0)
+
+        if _active:
+            _reset_hwm()
+
+    @property
+    def peak_mb(self) -> Optional[float]:
+        if self.peak_bytes is None:
+            return None
+        return round(self.peak_bytes / MB, 1)
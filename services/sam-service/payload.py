@@ -0,0 +1,433 @@
+"""
+Request/Response Payloads
+Streaming JSON body parsing with incremental base64 image decoding, and
+streamed JSON responses carrying a base64 mask
+"""
+
+import base64
+import binascii
+import io
+import json
+import logging
+from typing import Iterator, Optional, Tuple, Type
+
+import cv2
+import numpy as np
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from PIL import Image
+from pydantic import BaseModel, ValidationError
+
+from memory import Reservation
+
+logger = logging.getLogger(__name__)
+
+# Base64 characters kept by the decoder, everything else is dropped like b64decode does
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+_B64_DELETE = bytes(sorted(set(range(256)) - set(_B64_ALPHABET)))
+
+# Data URL prefixes ("data:image/png;base64,") are short; give up looking after this
+_MAX_PREFIX = 256
+
+# Header probing: first attempt after this many image bytes, give up after the max
+_PROBE_START = 1024
+_PROBE_MAX = 1024 * 1024
+
+# Response chunk, a multiple of 3 so every chunk encodes without padding
+_RESPONSE_CHUNK = 3 * 64 * 1024
+
+# Bytes reserved per pixel while a request's job runs on the worker:
+#   3  decoded RGB image
+#   4  full-resolution float32 logits built by SamPredictor.predict before
+#      thresholding (kept until _logits_to_alpha for alpha mattes)
+#   1  bool mask (or the stitched output mask in tiled mode)
+#   1  uint8 copy for post-processing and PNG encoding
+#   1  headroom for the PNG encoder, contour temporaries and tile buffers
+BYTES_PER_PIXEL = 10
+
+_NORMAL, _AWAIT_IMAGE, _IMAGE = range(3)
+
+
+class PayloadError(Exception):
+    """Rejected request payload, carries the HTTP status to respond with"""
+
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+        super().__init__(detail)
+
+
+class EncodedImage:
+    """Compressed image bytes from a request, decoded on demand"""
+
+    def __init__(self, data: bytearray, width: int, height: int):
+        self._data = data
+        self.nbytes = len(data)
+        self.width = width
+        self.height = height
+        # Memory the job needs once the image is decoded
+        self.working_bytes = width * height * BYTES_PER_PIXEL
+
+    def decode(self) -> np.ndarray:
+        """
+        Decode to an RGB numpy array and release the compressed bytes
+
+        Returns:
+            RGB image as numpy array (H, W, 3)
+        """
+        buffer = np.frombuffer(self._data, dtype=np.uint8)
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        del buffer
+
+        if image is not None:
+            # Swap channels in place instead of allocating a second array
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+        else:
+            # Formats OpenCV cannot read (e.g. GIF)
+            try:
+                with Image.open(io.BytesIO(self._data)) as pil_image:
+                    if pil_image.mode != 'RGB':
+                        pil_image = pil_image.convert('RGB')
+                    image = np.asarray(pil_image)
+            except Exception as e:
+                logger.error(f"Failed to decode image: {e}")
+                raise PayloadError(400, "Invalid image format")
+
+        self.release()
+        return image
+
+    def release(self):
+        """Drop the compressed bytes"""
+        self._data = None
+
+
+class _SegmentBodyParser:
+    """
+    Incremental parser for a JSON object with a large base64 "image" field
+
+    Everything except the image string is copied to a small buffer that is
+    parsed with json at the end (the image value is replaced by ""). The
+    image string is base64-decoded as it arrives, so neither the JSON text
+    nor the base64 text of the image is ever held in full.
+    """
+
+    IMAGE_KEY = b"image"
+
+    def __init__(self, reservation: Reservation, max_image_bytes: int, max_pixels: int):
+        self.reservation = reservation
+        self.max_image_bytes = max_image_bytes
+        self.max_pixels = max_pixels
+
+        self.rest = bytearray()
+        self.image = bytearray()
+        self.seen_image = False
+        self.size: Optional[Tuple[int, int]] = None
+
+        self._state = _NORMAL
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()
+        self._last_string: Optional[bytes] = None
+
+        self._image_escape = False
+        self._head: Optional[bytearray] = bytearray()
+        self._carry = b""
+        self._next_probe = _PROBE_START
+
+    def feed(self, chunk: bytes):
+        i = 0
+        n = len(chunk)
+
+        while i < n:
+            if self._state == _IMAGE:
+                i = self._feed_image(chunk, i)
+                continue
+
+            c = chunk[i]
+
+            if self._state == _AWAIT_IMAGE:
+                if c in b" \t\r\n":
+                    self.rest.append(c)
+                    i += 1
+                    continue
+                if c == 0x22:  # "
+                    self.rest += b'""'
+                    self.seen_image = True
+                    self._state = _IMAGE
+                    i += 1
+                    continue
+                # Not a string, leave it to validation
+                self._state = _NORMAL
+
+            self.rest.append(c)
+            i += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == 0x5C:  # backslash
+                    self._escape = True
+                elif c == 0x22:
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = bytes(self._string)
+                elif self._depth == 1 and len(self._string) <= len(self.IMAGE_KEY):
+                    self._string.append(c)
+            elif c == 0x22:
+                self._in_string = True
+                self._string.clear()
+            elif c in b"{[":
+                self._depth += 1
+            elif c in b"}]":
+                self._depth -= 1
+            elif c == 0x3A:  # :
+                # A string followed by ':' at the top level is a key
+                if self._depth == 1 and self._last_string == self.IMAGE_KEY:
+                    self._state = _AWAIT_IMAGE
+                self._last_string = None
+            elif c == 0x2C:  # ,
+                self._last_string = None
+
+    def close(self):
+        """Finish parsing, the image is complete after this"""
+        if self._state != _NORMAL or self._in_string:
+            raise PayloadError(400, "Truncated request body")
+
+        if self.seen_image:
+            self._finish_image()
+
+    def decode_value(self, value: str):
+        """
+        Decode an image value the streaming pass did not pick up
+
+        Used when the "image" key was not recognised while streaming (e.g.
+        written with escapes) and the value ended up in the parsed fields.
+        """
+        if self.seen_image:
+            raise ValueError("Image was already decoded while streaming")
+
+        self.seen_image = True
+        self._push(value.encode())
+        self._finish_image()
+
+    def _feed_image(self, chunk: bytes, i: int) -> int:
+        """Consume image string bytes from chunk[i:], return the next index"""
+        n = len(chunk)
+
+        while i < n:
+            if self._image_escape:
+                self._image_escape = False
+                c = chunk[i]
+                i += 1
+                if c == 0x2F:  # \/
+                    self._push(b"/")
+                elif c not in b"nrt":  # wrapped base64 is fine, anything else is not
+                    raise PayloadError(400, "Invalid image format")
+                continue
+
+            quote = chunk.find(b'"', i)
+            backslash = chunk.find(b"\\", i, quote if quote >= 0 else n)
+
+            if backslash >= 0:
+                self._push(chunk[i:backslash])
+                self._image_escape = True
+                i = backslash + 1
+            elif quote >= 0:
+                self._push(chunk[i:quote])
+                self._state = _NORMAL
+                return quote + 1
+            else:
+                self._push(chunk[i:])
+                return n
+
+        return n
+
+    def _push(self, data: bytes):
+        """Strip the data URL prefix, then decode"""
+        if self._head is not None:
+            self._head += data
+            comma = self._head.find(b",")
+            if comma >= 0:
+                data = bytes(self._head[comma + 1:])
+            elif len(self._head) > _MAX_PREFIX:
+                data = bytes(self._head)
+            else:
+                return
+            self._head = None
+
+        self._decode(data)
+
+    def _decode(self, data: bytes):
+        """Decode whole base64 quanta, carrying the remainder to the next call"""
+        data = self._carry + data.translate(None, _B64_DELETE)
+        usable = len(data) - len(data) % 4
+
+        if usable:
+            try:
+                decoded = binascii.a2b_base64(data[:usable])
+            except binascii.Error:
+                raise PayloadError(400, "Invalid image format")
+            self._append(decoded)
+
+        self._carry = data[usable:]
+
+    def _finish_image(self):
+        if self._head is not None:
+            data = bytes(self._head)
+            self._head = None
+            self._decode(data)
+
+        if self._carry:
+            raise PayloadError(400, "Invalid image format")
+
+        if self.size is None:
+            self._probe(final=True)
+
+    def _append(self, decoded: bytes):
+        if len(self.image) + len(decoded) > self.max_image_bytes:
+            raise PayloadError(
+                413, f"Image exceeds {self.max_image_bytes // (1024 * 1024)} MB limit"
+            )
+
+        self.reservation.add(len(decoded))
+        self.image += decoded
+
+        if self.size is None and len(self.image) >= self._next_probe:
+            self._probe(final=False)
+
+    def _probe(self, final: bool):
+        """
+        Read the image dimensions from its header and reject oversized images
+        before the rest of the body is received
+        """
+        try:
+            with Image.open(io.BytesIO(bytes(self.image[:_PROBE_MAX]))) as header:
+                width, height = header.size
+        except Image.DecompressionBombError:
+            raise PayloadError(413, "Image dimensions too large")
+        except Exception:
+            if final or self._next_probe >= _PROBE_MAX:
+                raise PayloadError(400, "Invalid image format")
+            self._next_probe *= 4
+            return
+
+        if self.max_pixels and width * height > self.max_pixels:
+            raise PayloadError(
+                413, f"Image is {width}x{height}, limit is {self.max_pixels} pixels"
+            )
+
+        self.size = (width, height)
+
+
+async def read_segment_request(
+    request: Request,
+    model: Type[BaseModel],
+    reservation: Reservation,
+    max_image_bytes: int,
+    max_pixels: int,
+) -> Tuple[BaseModel, EncodedImage]:
+    """
+    Read a segmentation request body without buffering it
+
+    Args:
+        request: Incoming request
+        model: Pydantic model for the non-image fields
+        reservation: Memory reservation grown by the compressed image bytes
+        max_image_bytes: Maximum compressed image size
+        max_pixels: Maximum image width * height (0 = unlimited)
+
+    Returns:
+        Validated request model (image field blanked) and the compressed image
+
+    Raises:
+        PayloadError: Invalid or oversized payload
+        MemoryBudgetExceeded: Request does not fit in the memory budget
+        RequestValidationError: Invalid JSON or fields
+    """
+    # base64 inflates by 4/3, allow some room for the other fields
+    max_body = max_image_bytes * 4 // 3 + 1024 * 1024
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_body:
+        raise PayloadError(413, "Request body too large")
+
+    parser = _SegmentBodyParser(reservation, max_image_bytes, max_pixels)
+    received = 0
+
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_body:
+            raise PayloadError(413, "Request body too large")
+        parser.feed(chunk)
+
+    parser.close()
+
+    try:
+        fields = json.loads(parser.rest)
+    except ValueError:
+        raise RequestValidationError(
+            [{"type": "json_invalid", "loc": ("body",), "msg": "JSON decode error", "input": {}}]
+        )
+    del parser.rest
+
+    try:
+        parsed = model.model_validate(fields)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body",) + tuple(error["loc"])} for error in e.errors()]
+        )
+
+    if not parser.seen_image:
+        # Image value was not a plain top-level string (e.g. escaped key), decode it now
+        parser.decode_value(parsed.image)
+        parsed.image = ""
+
+    width, height = parser.size
+    return parsed, EncodedImage(parser.image, width, height)
+
+
+def stream_segment_response(mask_png: bytes, **fields) -> Iterator[bytes]:
+    """
+    Stream a SegmentResponse JSON body, base64-encoding the mask chunk by chunk
+
+    Args:
+        mask_png: PNG bytes of the mask
+        fields: Remaining SegmentResponse fields
+
+    Yields:
+        JSON body chunks
+    """
+    head = json.dumps(fields)
+    yield (head[:-1] + ', "maskBase64": "data:image/png;base64,').encode()
+
+    view = memoryview(mask_png)
+    for start in range(0, len(view), _RESPONSE_CHUNK):
+        yield base64.b64encode(view[start:start + _RESPONSE_CHUNK])
+
+    yield b'"}'
+
+
+def _inline_refs(schema, defs: dict):
+    """Replace local $defs references so the schema can be embedded anywhere"""
+    if isinstance(schema, dict):
+        ref = schema.get("$ref", "")
+        if ref.startswith("#/$defs/"):
+            return _inline_refs(defs[ref[len("#/$defs/"):]], defs)
+        return {key: _inline_refs(value, defs) for key, value in schema.items()}
+    if isinstance(schema, list):
+        return [_inline_refs(item, defs) for item in schema]
+    return schema
+
+
+def json_body(model: Type[BaseModel]) -> dict:
+    """OpenAPI request body for endpoints that read the body themselves"""
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+
+    return {
+        "requestBody": {
+            "content": {"application/json": {"schema": _inline_refs(schema, defs)}},
+            "required": True,
+        }
+    }
@@ -0,0 +1,97 @@
+"""
+Mask Post-processing
+Vectorized clean-up of predictor masks before encoding (islands, holes,
+dilate/erode, feathering). The result is written in place into one uint8
+buffer; island removal and hole filling use transient full-size scratch
+arrays (see _clean_regions)
+"""
+
+import cv2
+import numpy as np
+
+# Values >= this count as foreground in a soft (alpha) mask, i.e. logit >= 0
+ALPHA_THRESHOLD = 128
+
+
+def _clean_regions(mask: np.ndarray, soft: bool, fill_holes: bool, min_area: int):
+    """
+    Remove small foreground regions and/or fill holes, in place
+
+    Region sizes are exact pixel counts from 8-connected components, which
+    needs a transient int32 label image (4 bytes per pixel) and a bool array
+    of pixels to remove. Holes are found afterwards from a two-level contour
+    hierarchy, so holes of removed regions are ignored. Soft masks also need
+    a thresholded uint8 copy, and hole filling a uint8 scratch so that only
+    background pixels are filled and the matte values of the rim are kept.
+    """
+    # Soft masks are thresholded into a temporary; binary masks are 0/255 already
+    binary = (mask >= ALPHA_THRESHOLD).view(np.uint8) if soft else mask
+
+    if min_area > 0:
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        small = stats[:, cv2.CC_STAT_AREA] < min_area
+        small[0] = False  # background
+        if small[1:].any():
+            remove = small[labels]
+            mask[remove] = 0
+            if soft:
+                binary[remove] = 0
+            del remove
+        del labels
+
+    if fill_holes:
+        contours, hierarchy = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        if hierarchy is not None:
+            holes = [contour for contour, node in zip(contours, hierarchy[0]) if node[3] != -1]
+            if holes and soft:
+                # Hole contours run along the foreground rim, fill onto a scratch
+                # and keep only pixels that were background
+                filled = np.zeros_like(binary)
+                cv2.drawContours(filled, holes, -1, 1, thickness=cv2.FILLED)
+                np.greater(filled, binary, out=filled)
+                mask[filled.view(bool)] = 255
+                del filled
+            elif holes:
+                cv2.drawContours(mask, holes, -1, 255, thickness=cv2.FILLED)
+
+
+def postprocess_mask(mask: np.ndarray, dilate: int = 0, fill_holes: bool = False,
+                     min_area: int = 0, feather: int = 0) -> np.ndarray:
+    """
+    Post-process a predictor mask into an 8-bit mask ready for encoding
+
+    Args:
+        mask: Binary mask (bool, H x W) or soft alpha mask (uint8, H x W)
+        dilate: Radius in pixels to grow the mask by, negative to shrink
+        fill_holes: Fill enclosed background regions
+        min_area: Remove foreground regions smaller than this many pixels
+        feather: Width in pixels of the soft edge ramp
+
+    Returns:
+        uint8 mask (0-255); binary input is converted once and then
+        modified in place, soft input is modified in place
+    """
+    soft = mask.dtype != bool
+    if soft:
+        out = mask
+    else:
+        # The only full-size copy: bool -> 0/255
+        out = mask.astype(np.uint8)
+        out *= 255
+
+    if min_area > 0 or fill_holes:
+        _clean_regions(out, soft, fill_holes, min_area)
+
+    if dilate:
+        radius = abs(dilate)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+        if dilate > 0:
+            cv2.dilate(out, kernel, dst=out)
+        else:
+            cv2.erode(out, kernel, dst=out)
+
+    if feather > 0:
+        size = 2 * feather + 1
+        cv2.GaussianBlur(out, (size, size), feather / 2, dst=out)
+
+    return out
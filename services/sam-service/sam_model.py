@@ -4,17 +4,74 @@ Handles model loading, inference, and mask generation
 """
 
 import os
-import torch
+import math
 import numpy as np
+import cv2
 from PIL import Image
-from mobile_sam import sam_model_registry, SamPredictor
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# Encoder input size, images are resized so the longest side matches this
+ENCODER_SIZE = 1024
+
+
+def _logits_to_alpha(logits: np.ndarray) -> np.ndarray:
+    """
+    Convert full-resolution mask logits to an 8-bit alpha matte
+
+    The sigmoid is computed in place on the float logits, so the only new
+    full-size allocation is the uint8 result.
+    """
+    with np.errstate(over="ignore"):
+        np.negative(logits, out=logits)
+        np.exp(logits, out=logits)
+    logits += 1
+    np.reciprocal(logits, out=logits)
+    logits *= 255
+    logits += 0.5
+    return logits.astype(np.uint8)
+
+
+def _tile_spans(start: int, end: int, tile: int, overlap: int, limit: int) -> list:
+    """
+    Split [start, end) into overlapping tiles along one axis
+
+    Each tile owns the half of every overlap that is nearest to it, so the
+    owned ranges cover [start, end) exactly once and can be written straight
+    into the output mask without blending.
+
+    Returns:
+        List of (tile_start, tile_end, own_start, own_end) in image coordinates
+    """
+    tile = min(tile, limit)
+
+    # Region smaller than a tile: center one tile on it for extra context
+    if end - start <= tile:
+        tile_start = min(max((start + end - tile) // 2, 0), limit - tile)
+        return [(tile_start, tile_start + tile, start, end)]
+
+    step = max(tile - overlap, 1)
+    starts = list(range(start, end - tile, step)) + [end - tile]
+
+    spans = []
+    own_start = start
+    for i, tile_start in enumerate(starts):
+        if i + 1 < len(starts):
+            # Boundary in the middle of the overlap with the next tile
+            own_end = (starts[i + 1] + tile_start + tile) // 2
+        else:
+            own_end = end
+        spans.append((tile_start, tile_start + tile, own_start, own_end))
+        own_start = own_end
+
+    return spans
+
+
 class SAMModel:
-    def __init__(self, model_type="mobile_sam", checkpoint_path="mobile_sam.pt", device="auto"):
+    def __init__(self, model_type="mobile_sam", checkpoint_path="mobile_sam.pt", device="auto",
+                 tile_size=ENCODER_SIZE, tile_overlap=128):
         """
         Initialize SAM model
 
@@ -22,12 +79,24 @@ class SAMModel:
             model_type: Type of model (mobile_sam, sam_vit_b, sam_vit_l, sam_vit_h)
             checkpoint_path: Path to model checkpoint
             device: Device to run on (cuda, cpu, auto)
+            tile_size: Tile edge in pixels for tiled high-resolution segmentation
+            tile_overlap: Overlap between neighbouring tiles in pixels
         """
+        if tile_size <= 0:
+            raise ValueError(f"tile_size must be positive, got {tile_size}")
+        if not 0 <= tile_overlap < tile_size:
+            raise ValueError(
+                f"tile_overlap must be in [0, tile_size), got {tile_overlap} with tile_size {tile_size}"
+            )
+
         self.model_type = model_type
         self.checkpoint_path = checkpoint_path
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
 
         # Auto-detect device
         if device == "auto":
+            import torch
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
         else:
             self.device = device
@@ -41,6 +110,9 @@ class SAMModel:
 
     def _load_model(self):
         """Load the SAM model"""
+        # Imported here so tiling and mask helpers work without the model stack
+        from mobile_sam import sam_model_registry, SamPredictor
+
         try:
             # Map model type to registry key
             model_registry_key = {
@@ -64,7 +136,7 @@ class SAMModel:
             logger.error(f"❌ Failed to load SAM model: {e}")
             raise
 
-    def segment_by_point(self, image: np.ndarray, point: tuple, label: int = 1):
+    def segment_by_point(self, image: np.ndarray, point: tuple, label: int = 1, soft: bool = False):
         """
         Segment object by single point
 
@@ -72,9 +144,10 @@ class SAMModel:
             image: RGB image as numpy array (H, W, 3)
             point: (x, y) coordinates
             label: 1 for foreground, 0 for background
+            soft: Return an 8-bit alpha matte from the logits instead of a binary mask
 
         Returns:
-            mask: Binary mask as numpy array (H, W)
+            mask: Binary mask as numpy array (H, W), uint8 alpha matte if soft
             score: Confidence score
         """
         try:
@@ -89,11 +162,12 @@ class SAMModel:
             masks, scores, logits = self.predictor.predict(
                 point_coords=point_coords,
                 point_labels=point_labels,
-                multimask_output=False
+                multimask_output=False,
+                return_logits=soft
             )
 
             # Return best mask
-            mask = masks[0]
+            mask = _logits_to_alpha(masks[0]) if soft else masks[0]
             score = float(scores[0])
 
             logger.info(f"✅ Segmented by point {point} with score {score:.3f}")
@@ -104,7 +178,7 @@ class SAMModel:
             logger.error(f"❌ Segmentation failed: {e}")
             raise
 
-    def segment_by_points(self, image: np.ndarray, points: list, labels: list = None):
+    def segment_by_points(self, image: np.ndarray, points: list, labels: list = None, soft: bool = False):
         """
         Segment object by multiple points
 
@@ -112,9 +186,10 @@ class SAMModel:
             image: RGB image as numpy array (H, W, 3)
             points: List of (x, y) coordinates
             labels: List of labels (1 for foreground, 0 for background)
+            soft: Return an 8-bit alpha matte from the logits instead of a binary mask
 
         Returns:
-            mask: Binary mask as numpy array (H, W)
+            mask: Binary mask as numpy array (H, W), uint8 alpha matte if soft
             score: Confidence score
         """
         try:
@@ -133,11 +208,12 @@ class SAMModel:
             masks, scores, logits = self.predictor.predict(
                 point_coords=point_coords,
                 point_labels=point_labels,
-                multimask_output=False
+                multimask_output=False,
+                return_logits=soft
             )
 
             # Return best mask
-            mask = masks[0]
+            mask = _logits_to_alpha(masks[0]) if soft else masks[0]
             score = float(scores[0])
 
             logger.info(f"✅ Segmented by {len(points)} points with score {score:.3f}")
@@ -148,16 +224,17 @@ class SAMModel:
             logger.error(f"❌ Multi-point segmentation failed: {e}")
             raise
 
-    def segment_by_box(self, image: np.ndarray, box: tuple):
+    def segment_by_box(self, image: np.ndarray, box: tuple, soft: bool = False):
         """
         Segment object by bounding box
 
         Args:
             image: RGB image as numpy array (H, W, 3)
             box: (x1, y1, x2, y2) coordinates
+            soft: Return an 8-bit alpha matte from the logits instead of a binary mask
 
         Returns:
-            mask: Binary mask as numpy array (H, W)
+            mask: Binary mask as numpy array (H, W), uint8 alpha matte if soft
             score: Confidence score
         """
         try:
@@ -170,11 +247,12 @@ class SAMModel:
             # Predict
             masks, scores, logits = self.predictor.predict(
                 box=box_coords,
-                multimask_output=False
+                multimask_output=False,
+                return_logits=soft
             )
 
             # Return best mask
-            mask = masks[0]
+            mask = _logits_to_alpha(masks[0]) if soft else masks[0]
             score = float(scores[0])
 
             logger.info(f"✅ Segmented by box with score {score:.3f}")
@@ -185,18 +263,172 @@ class SAMModel:
             logger.error(f"❌ Box segmentation failed: {e}")
             raise
 
+    def segment_tiled(self, image: np.ndarray, points: list = None, labels: list = None,
+                      box: tuple = None, soft: bool = False, on_tile=None):
+        """
+        Segment a large image at full resolution using overlapping tiles
+
+        A coarse pass on a downscaled copy locates the object. Tiles covering
+        that region are then encoded one at a time at native resolution,
+        prompted with the part of the coarse mask that falls inside them, and
+        their masks are written directly into the output. Only one tile
+        embedding is alive at a time, so extra memory stays bounded by the
+        tile size rather than the image size. With soft=True each tile's
+        logits are converted to alpha before stitching.
+
+        Args:
+            image: RGB image as numpy array (H, W, 3)
+            points: List of (x, y) coordinates
+            labels: List of labels (1 for foreground, 0 for background)
+            box: (x1, y1, x2, y2) coordinates
+            soft: Return an 8-bit alpha matte from the logits instead of a binary mask
+            on_tile: Optional callable run before each tile is encoded, e.g. to
+                let waiting interactive requests use the predictor
+
+        Returns:
+            mask: Binary mask as numpy array (H, W), uint8 alpha matte if soft
+            score: Confidence score
+        """
+        try:
+            height, width = image.shape[:2]
+
+            if points is not None:
+                point_coords = np.array(points, dtype=np.float64).reshape(-1, 2)
+                if labels is None:
+                    point_labels = np.ones(len(point_coords), dtype=int)
+                else:
+                    point_labels = np.array(labels)
+            else:
+                point_coords = None
+                point_labels = None
+
+            box_coords = np.array(box, dtype=np.float64) if box is not None else None
+
+            # Coarse pass on a downscaled copy
+            scale = min(1.0, ENCODER_SIZE / max(height, width))
+            if scale < 1.0:
+                coarse_image = cv2.resize(
+                    image,
+                    (max(1, round(width * scale)), max(1, round(height * scale))),
+                    interpolation=cv2.INTER_AREA
+                )
+            else:
+                coarse_image = image
+
+            self.predictor.set_image(coarse_image)
+            del coarse_image
+
+            masks, scores, logits = self.predictor.predict(
+                point_coords=point_coords * scale if point_coords is not None else None,
+                point_labels=point_labels,
+                box=box_coords * scale if box_coords is not None else None,
+                multimask_output=False
+            )
+            coarse_mask = masks[0]
+            coarse_score = float(scores[0])
+            del masks, logits
+
+            mask = np.zeros((height, width), dtype=np.uint8 if soft else bool)
+
+            ys, xs = np.nonzero(coarse_mask)
+            if len(xs) == 0:
+                logger.info(f"✅ Tiled segmentation found no object (coarse score {coarse_score:.3f})")
+                return mask, coarse_score
+
+            # Region of interest in full-resolution coordinates, padded by one
+            # overlap so object edges lost in the coarse pass are still covered
+            pad = self.tile_overlap
+            x0 = max(int(xs.min() / scale) - pad, 0)
+            y0 = max(int(ys.min() / scale) - pad, 0)
+            x1 = min(int(math.ceil((xs.max() + 1) / scale)) + pad, width)
+            y1 = min(int(math.ceil((ys.max() + 1) / scale)) + pad, height)
+            del ys, xs
+
+            weighted_score = 0.0
+            weight = 0
+            tiles = 0
+
+            for ty0, ty1, oy0, oy1 in _tile_spans(y0, y1, self.tile_size, self.tile_overlap, height):
+                for tx0, tx1, ox0, ox1 in _tile_spans(x0, x1, self.tile_size, self.tile_overlap, width):
+                    # Part of the coarse mask inside this tile
+                    cx0, cy0 = int(tx0 * scale), int(ty0 * scale)
+                    cx1 = int(math.ceil(tx1 * scale))
+                    cy1 = int(math.ceil(ty1 * scale))
+                    tile_ys, tile_xs = np.nonzero(coarse_mask[cy0:cy1, cx0:cx1])
+                    if len(tile_xs) == 0:
+                        continue
+
+                    tile_box = np.array([
+                        max((cx0 + tile_xs.min()) / scale - pad, tx0),
+                        max((cy0 + tile_ys.min()) / scale - pad, ty0),
+                        min((cx0 + tile_xs.max() + 1) / scale + pad, tx1),
+                        min((cy0 + tile_ys.max() + 1) / scale + pad, ty1),
+                    ]) - [tx0, ty0, tx0, ty0]
+
+                    tile_points = None
+                    tile_labels = None
+                    if point_coords is not None:
+                        inside = (
+                            (point_coords[:, 0] >= tx0) & (point_coords[:, 0] < tx1) &
+                            (point_coords[:, 1] >= ty0) & (point_coords[:, 1] < ty1)
+                        )
+                        if inside.any():
+                            tile_points = point_coords[inside] - [tx0, ty0]
+                            tile_labels = point_labels[inside]
+
+                    if on_tile is not None:
+                        on_tile()
+
+                    self.predictor.set_image(np.ascontiguousarray(image[ty0:ty1, tx0:tx1]))
+                    tile_masks, tile_scores, _ = self.predictor.predict(
+                        point_coords=tile_points,
+                        point_labels=tile_labels,
+                        box=tile_box,
+                        multimask_output=False,
+                        return_logits=soft
+                    )
+
+                    # Keep only the part of the tile this tile owns
+                    owned = tile_masks[0][oy0 - ty0:oy1 - ty0, ox0 - tx0:ox1 - tx0]
+                    if soft:
+                        owned = _logits_to_alpha(owned)
+                    mask[oy0:oy1, ox0:ox1] = owned
+
+                    area = int(np.count_nonzero(owned >= 128 if soft else owned))
+                    weighted_score += float(tile_scores[0]) * area
+                    weight += area
+                    tiles += 1
+                    del tile_masks, owned
+
+            self.predictor.reset_image()
+
+            score = weighted_score / weight if weight else coarse_score
+
+            logger.info(f"✅ Tiled segmentation of {width}x{height} image over {tiles} tiles with score {score:.3f}")
+
+            return mask, score
+
+        except Exception as e:
+            logger.error(f"❌ Tiled segmentation failed: {e}")
+            raise
+
     def mask_to_image(self, mask: np.ndarray) -> Image.Image:
         """
         Convert binary mask to PIL Image
 
         Args:
-            mask: Binary mask (True/False or 0/1)
+            mask: Binary mask (True/False), or uint8 mask already scaled to 0-255
 
         Returns:
             PIL Image (black background, white foreground)
         """
-        # Convert to uint8 (0 or 255)
-        mask_uint8 = (mask * 255).astype(np.uint8)
+        # Post-processed and soft masks are encoded as is
+        if mask.dtype == np.uint8:
+            return Image.fromarray(mask, mode='L')
+
+        # Convert to uint8 (0 or 255) in place, avoiding a full-size int64 temporary
+        mask_uint8 = mask.astype(np.uint8)
+        mask_uint8 *= 255
 
         # Convert to PIL Image
         mask_image = Image.fromarray(mask_uint8, mode='L')
@@ -0,0 +1,299 @@
+"""
+Priority Scheduler
+Orders SAM inference jobs by priority class with per-tenant fair queueing
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+# Highest priority first
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+DEFAULT_TENANT = "default"
+
+
+class QueueFullError(Exception):
+    """Raised when a tenant has reached its share of a priority class queue"""
+
+    def __init__(self, priority: str, limit: int, tenant: str = DEFAULT_TENANT):
+        self.priority = priority
+        self.limit = limit
+        self.tenant = tenant
+        super().__init__(f"{priority} queue is full for tenant '{tenant}' ({limit} pending)")
+
+
+class _Job:
+    __slots__ = ("fn", "future")
+
+    def __init__(self, fn: Callable[[], Any], future: asyncio.Future):
+        self.fn = fn
+        self.future = future
+
+
+class PriorityScheduler:
+    def __init__(self, max_queue_depth: Dict[str, int], batch_defer_ms: int = 0,
+                 max_tenant_depth: Optional[Dict[str, int]] = None):
+        """
+        Initialize scheduler
+
+        The SAM predictor keeps per-image state between set_image and predict,
+        so jobs run one at a time on a dedicated worker thread. Interactive
+        jobs are always dispatched before batch jobs; within a class, tenants
+        are served round-robin so one tenant cannot starve the others.
+
+        Admission is fair too: a tenant is rejected once it has
+        max_tenant_depth jobs pending, and when a class is full the newest
+        job of the tenant with the most pending jobs is shed to make room for
+        a tenant with fewer, so only the heaviest tenant sees QueueFullError.
+
+        Args:
+            max_queue_depth: Maximum pending jobs per priority class
+            batch_defer_ms: Hold batch jobs back this long after the last
+                interactive job finished, so follow-up clicks are not stuck
+                behind a bulk job
+            max_tenant_depth: Maximum pending jobs per tenant in each
+                priority class (missing or 0 = the class limit)
+        """
+        self.max_queue_depth = max_queue_depth
+        self.max_tenant_depth = max_tenant_depth or {}
+        self.batch_defer = batch_defer_ms / 1000.0
+
+        # priority -> tenant -> deque of jobs (insertion order = round-robin order)
+        self._queues: Dict[str, "OrderedDict[str, deque]"] = {
+            priority: OrderedDict() for priority in PRIORITY_CLASSES
+        }
+        self._depth: Dict[str, int] = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._last_interactive = 0.0
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam-worker")
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def normalize_priority(value: Optional[str]) -> str:
+        """
+        Resolve a priority class name
+
+        Args:
+            value: Requested priority (case-insensitive), None for default
+
+        Returns:
+            Priority class name
+
+        Raises:
+            ValueError: If the priority class is unknown
+        """
+        if value is None or value == "":
+            return PRIORITY_INTERACTIVE
+
+        priority = value.strip().lower()
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(
+                f"Unknown priority '{value}', expected one of: {', '.join(PRIORITY_CLASSES)}"
+            )
+
+        return priority
+
+    def start(self):
+        """Start the dispatch loop (must be called from a running event loop)"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Scheduler started with queue limits {self.max_queue_depth}")
+
+    async def stop(self):
+        """Stop the dispatch loop and the worker thread"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, fn: Callable[[], Any], priority: str, tenant: Optional[str] = None) -> Any:
+        """
+        Queue a blocking job and wait for its result
+
+        Args:
+            fn: Callable run on the worker thread
+            priority: Priority class name
+            tenant: Tenant identifier for fair queueing
+
+        Returns:
+            Return value of fn
+
+        Raises:
+            QueueFullError: If the tenant is at its pending-job limit, or the
+                priority class queue is full and no other tenant has more
+                jobs pending. Also raised for a queued job that was shed to
+                admit another tenant's job.
+        """
+        tenant = tenant or DEFAULT_TENANT
+        tenants = self._queues[priority]
+        pending = len(tenants.get(tenant, ()))
+
+        tenant_limit = self.max_tenant_depth.get(priority) or self.max_queue_depth[priority]
+        if pending >= tenant_limit:
+            raise QueueFullError(priority, tenant_limit, tenant)
+
+        if self._depth[priority] >= self.max_queue_depth[priority]:
+            self._shed(priority, tenant, pending)
+
+        future = asyncio.get_running_loop().create_future()
+        tenants.setdefault(tenant, deque()).append(_Job(fn, future))
+        self._depth[priority] += 1
+        self._wakeup.set()
+
+        # If the caller goes away the future is cancelled and the job is
+        # dropped when it reaches the head of the queue
+        return await future
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Current queue depth and tenant count per priority class"""
+        return {
+            priority: {
+                "pending": self._depth[priority],
+                "tenants": len(self._queues[priority]),
+                "limit": self.max_queue_depth[priority],
+                "tenantLimit": self.max_tenant_depth.get(priority) or self.max_queue_depth[priority],
+            }
+            for priority in PRIORITY_CLASSES
+        }
+
+    def checkpoint(self):
+        """
+        Run pending interactive jobs now
+
+        Called from the worker thread between steps of a long job (e.g.
+        between tiles of a tiled segmentation), so a running batch job does
+        not hold interactive requests back for its whole runtime. The caller
+        must not rely on predictor state across this call.
+        """
+        if self._loop is None:
+            return
+
+        while True:
+            job = asyncio.run_coroutine_threadsafe(self._take_interactive(), self._loop).result()
+            if job is None:
+                return
+
+            try:
+                result = job.fn()
+            except Exception as e:
+                self._loop.call_soon_threadsafe(self._complete, job, None, e)
+            else:
+                self._loop.call_soon_threadsafe(self._complete, job, result, None)
+            finally:
+                self._last_interactive = time.monotonic()
+
+    async def _take_interactive(self) -> Optional[_Job]:
+        return self._pop(PRIORITY_INTERACTIVE)
+
+    @staticmethod
+    def _complete(job: _Job, result: Any, error: Optional[Exception]):
+        """Resolve a job's future unless its caller has gone away"""
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def _shed(self, priority: str, tenant: str, pending: int):
+        """
+        Make room in a full class by dropping the heaviest tenant's newest job
+
+        Raises:
+            QueueFullError: If no other tenant has more jobs pending than
+                the submitting one (pending)
+        """
+        tenants = self._queues[priority]
+        heaviest, jobs = max(tenants.items(), key=lambda item: len(item[1]))
+        if len(jobs) <= pending:
+            raise QueueFullError(priority, self.max_queue_depth[priority], tenant)
+
+        job = jobs.pop()
+        if not jobs:
+            del tenants[heaviest]
+        self._depth[priority] -= 1
+
+        logger.warning(f"Shed a {priority} job of tenant {heaviest} to admit tenant {tenant}")
+        self._complete(job, None, QueueFullError(priority, len(jobs) + 1, heaviest))
+
+    def _pop(self, priority: str) -> Optional[_Job]:
+        """Take the next live job of a priority class, rotating tenants"""
+        tenants = self._queues[priority]
+
+        while tenants:
+            tenant, jobs = next(iter(tenants.items()))
+            job = jobs.popleft()
+            if jobs:
+                tenants.move_to_end(tenant)
+            else:
+                del tenants[tenant]
+            self._depth[priority] -= 1
+
+            if not job.future.cancelled():
+                return job
+
+        return None
+
+    def _next_job(self):
+        """
+        Pick the next job to run
+
+        Returns:
+            (job, priority, wait): the job to run, or None with the number of
+            seconds to wait before looking again (None = until woken up)
+        """
+        job = self._pop(PRIORITY_INTERACTIVE)
+        if job is not None:
+            return job, PRIORITY_INTERACTIVE, None
+
+        if self._depth[PRIORITY_BATCH] == 0:
+            return None, None, None
+
+        remaining = self._last_interactive + self.batch_defer - time.monotonic()
+        if remaining > 0:
+            return None, None, remaining
+
+        job = self._pop(PRIORITY_BATCH)
+        return job, PRIORITY_BATCH, None
+
+    async def _run(self):
+        """Dispatch loop: run one job at a time on the worker thread"""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            self._wakeup.clear()
+            job, priority, wait = self._next_job()
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                result = await loop.run_in_executor(self._executor, job.fn)
+            except Exception as e:
+                self._complete(job, None, e)
+            else:
+                self._complete(job, result, None)
+            finally:
+                if priority == PRIORITY_INTERACTIVE:
+                    self._last_interactive = time.monotonic()
@@ -0,0 +1,96 @@
+"""
+Tests for request admission in the segment endpoints
+"""
+
+import asyncio
+import base64
+import io
+import threading
+
+import httpx
+import numpy as np
+from PIL import Image
+
+import app
+from memory import MemoryBudget
+from payload import BYTES_PER_PIXEL
+from sam_model import SAMModel
+from scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, PriorityScheduler
+
+
+class StubModel:
+    """Segments instantly, except the first call which waits to be released"""
+
+    mask_to_image = SAMModel.mask_to_image
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def is_ready(self):
+        return True
+
+    def segment_by_point(self, image, point, soft=False):
+        self.calls += 1
+        if self.calls == 1:
+            self.started.set()
+            self.release.wait(5)
+        return np.zeros(image.shape[:2], dtype=bool), 0.9
+
+
+def make_body(width, height) -> dict:
+    buffered = io.BytesIO()
+    Image.new("RGB", (width, height)).save(buffered, format="PNG")
+    return {"image": base64.b64encode(buffered.getvalue()).decode(), "point": [1, 1]}
+
+
+async def wait_for(condition):
+    for _ in range(5000):
+        if condition():
+            return
+        await asyncio.sleep(0.001)
+    raise AssertionError("condition not reached")
+
+
+def test_batch_backlog_does_not_reject_interactive(monkeypatch):
+    body = make_body(200, 200)
+    working_bytes = 200 * 200 * BYTES_PER_PIXEL
+
+    # Room for one running job plus the queued uploads, not for a second job
+    budget = MemoryBudget(working_bytes + 64 * 1024)
+    model = StubModel()
+    scheduler = PriorityScheduler({PRIORITY_INTERACTIVE: 16, PRIORITY_BATCH: 16})
+    monkeypatch.setattr(app, "memory_budget", budget)
+    monkeypatch.setattr(app, "sam_model", model)
+    monkeypatch.setattr(app, "scheduler", scheduler)
+
+    async def main():
+        scheduler.start()
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            def post(priority):
+                return asyncio.create_task(client.post(
+                    "/segment/point", json=body, headers={app.PRIORITY_HEADER: priority}
+                ))
+
+            running = post(PRIORITY_BATCH)
+            await wait_for(model.started.is_set)
+
+            backlog = [post(PRIORITY_BATCH) for _ in range(8)]
+            await wait_for(lambda: scheduler.stats()[PRIORITY_BATCH]["pending"] == 8)
+
+            interactive = post(PRIORITY_INTERACTIVE)
+            await wait_for(lambda: scheduler.stats()[PRIORITY_INTERACTIVE]["pending"] == 1)
+            assert budget.used < working_bytes + 64 * 1024
+
+            model.release.set()
+            responses = await asyncio.gather(running, interactive, *backlog)
+
+        await scheduler.stop()
+        return responses
+
+    responses = asyncio.run(main())
+
+    assert [response.status_code for response in responses] == [200] * 10
+    assert budget.used == 0
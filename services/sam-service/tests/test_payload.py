@@ -0,0 +1,186 @@
+"""
+Tests for the streaming request body parser
+"""
+
+import asyncio
+import base64
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+from pydantic import BaseModel
+from starlette.requests import Request
+
+from memory import MemoryBudget
+from payload import PayloadError, _SegmentBodyParser, read_segment_request
+
+
+class PointRequest(BaseModel):
+    image: str
+    point: list
+
+
+def make_png(width=40, height=30, noise=False) -> bytes:
+    if noise:
+        pixels = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    else:
+        pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    buffered = io.BytesIO()
+    Image.fromarray(pixels).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def make_parser(max_image_bytes=10 * 1024 * 1024, max_pixels=0) -> _SegmentBodyParser:
+    return _SegmentBodyParser(MemoryBudget(0).reservation(), max_image_bytes, max_pixels)
+
+
+def feed_chunks(parser, body: bytes, size: int):
+    for start in range(0, len(body), size):
+        parser.feed(body[start:start + size])
+    parser.close()
+
+
+def make_request(body: bytes, chunk_size=7, headers=None) -> Request:
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i + 1 < len(chunks)}
+        for i, chunk in enumerate(chunks)
+    ]
+
+    async def receive():
+        return messages.pop(0)
+
+    raw_headers = [(b"content-type", b"application/json")]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), value.encode()))
+
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": raw_headers}
+    return Request(scope, receive)
+
+
+def read(body: bytes, **kwargs):
+    request = make_request(body, **kwargs)
+    reservation = MemoryBudget(0).reservation()
+    return asyncio.run(
+        read_segment_request(request, PointRequest, reservation, 10 * 1024 * 1024, 0)
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 5, 11, 64])
+def test_data_url_prefix_split_across_chunks(chunk_size):
+    png = make_png()
+    body = json.dumps({
+        "image": "data:image/png;base64," + base64.b64encode(png).decode(),
+        "point": [1, 2],
+    }).encode()
+
+    parser = make_parser()
+    feed_chunks(parser, body, chunk_size)
+
+    assert bytes(parser.image) == png
+    assert parser.size == (40, 30)
+    assert json.loads(parser.rest) == {"image": "", "point": [1, 2]}
+
+
+def test_escaped_slash_and_newline_in_base64():
+    png = make_png(noise=True)
+    encoded = base64.encodebytes(png).decode()  # wrapped every 76 chars
+    assert "/" in encoded and "\n" in encoded
+
+    body = json.dumps({"point": [1, 2], "image": encoded}).replace("/", "\\/").encode()
+
+    parser = make_parser()
+    feed_chunks(parser, body, 13)
+
+    assert bytes(parser.image) == png
+
+
+def test_escaped_key_falls_back_to_decode_value():
+    png = make_png()
+    body = (
+        '{"im\\u0061ge": "' + base64.b64encode(png).decode() + '", "point": [3, 4]}'
+    ).encode()
+
+    parsed, image = read(body)
+
+    assert parsed.point == [3, 4]
+    assert parsed.image == ""
+    assert (image.width, image.height) == (40, 30)
+    assert image.decode().shape == (30, 40, 3)
+
+
+def test_ingest_reserves_only_compressed_bytes():
+    png = make_png(400, 300)
+    body = json.dumps({"image": base64.b64encode(png).decode(), "point": [1, 2]}).encode()
+    reservation = MemoryBudget(0).reservation()
+
+    _, image = asyncio.run(read_segment_request(
+        make_request(body, chunk_size=64), PointRequest, reservation, 10 * 1024 * 1024, 0
+    ))
+
+    assert reservation.nbytes == len(png) == image.nbytes
+    assert image.working_bytes > 100 * image.nbytes
+
+
+def test_nested_image_keys_are_not_streamed():
+    png = make_png()
+    body = json.dumps({
+        "meta": {"image": "not-this-one", "list": [{"image": "nor-this"}]},
+        "image": base64.b64encode(png).decode(),
+        "point": [1, 2],
+    }).encode()
+
+    parser = make_parser()
+    feed_chunks(parser, body, 9)
+
+    assert bytes(parser.image) == png
+    fields = json.loads(parser.rest)
+    assert fields["meta"] == {"image": "not-this-one", "list": [{"image": "nor-this"}]}
+    assert fields["image"] == ""
+
+
+def test_truncated_body_is_rejected():
+    body = json.dumps({"image": base64.b64encode(make_png()).decode(), "point": [1, 2]}).encode()
+
+    parser = make_parser()
+    parser.feed(body[:len(body) // 2])
+
+    with pytest.raises(PayloadError) as error:
+        parser.close()
+    assert error.value.status_code == 400
+
+
+def test_oversized_image_rejected_from_header_before_body_ends():
+    png = make_png(200, 200, noise=True)
+    body = json.dumps({"image": base64.b64encode(png).decode(), "point": [1, 2]}).encode()
+    parser = make_parser(max_pixels=100 * 100)
+
+    fed = 0
+    with pytest.raises(PayloadError) as error:
+        for start in range(0, len(body), 4096):
+            parser.feed(body[start:start + 4096])
+            fed = start + 4096
+
+    assert error.value.status_code == 413
+    assert fed < len(body) // 2
+
+
+def test_content_length_over_limit_rejected_before_reading():
+    async def receive():
+        raise AssertionError("body must not be read")
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [(b"content-length", str(50 * 1024 * 1024).encode())],
+    }
+    reservation = MemoryBudget(0).reservation()
+
+    with pytest.raises(PayloadError) as error:
+        asyncio.run(read_segment_request(
+            Request(scope, receive), PointRequest, reservation, 1024 * 1024, 0
+        ))
+    assert error.value.status_code == 413
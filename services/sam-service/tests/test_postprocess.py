@@ -0,0 +1,111 @@
+"""
+Tests for mask post-processing
+"""
+
+import numpy as np
+
+from postprocess import postprocess_mask
+
+
+def square_with_hole() -> np.ndarray:
+    mask = np.zeros((200, 200), dtype=bool)
+    mask[50:150, 50:150] = True
+    mask[90:110, 90:110] = False
+    return mask
+
+
+def test_binary_mask_converted_to_0_255_without_touching_input():
+    mask = square_with_hole()
+    original = mask.copy()
+
+    out = postprocess_mask(mask)
+
+    assert out.dtype == np.uint8
+    assert set(np.unique(out)) == {0, 255}
+    assert np.array_equal(out == 255, mask)
+    assert np.array_equal(mask, original)
+
+
+def test_min_area_counts_pixels_of_thin_line():
+    mask = np.zeros((50, 120), dtype=bool)
+    mask[20, 10:100] = True  # 90 px, zero contour area
+
+    assert (postprocess_mask(mask, min_area=50) == 255).sum() == 90
+    assert (postprocess_mask(mask, min_area=91) == 255).sum() == 0
+
+
+def test_min_area_counts_every_pixel_of_square():
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[10:22, 10:22] = True  # 144 px, contour area 121
+
+    assert (postprocess_mask(mask, min_area=130) == 255).sum() == 144
+    assert (postprocess_mask(mask, min_area=144) == 255).sum() == 144
+    assert (postprocess_mask(mask, min_area=145) == 255).sum() == 0
+
+
+def test_min_area_removes_island_inside_hole():
+    mask = square_with_hole()
+    mask[98:101, 98:101] = True  # 9 px island in the hole
+    mask[5:8, 5:8] = True  # 9 px island outside
+
+    out = postprocess_mask(mask, min_area=20)
+
+    assert out[99, 99] == 0
+    assert out[6, 6] == 0
+    assert out[60, 60] == 255
+
+
+def test_fill_holes():
+    out = postprocess_mask(square_with_hole(), fill_holes=True)
+
+    assert out[100, 100] == 255
+    assert (out == 255).sum() == 100 * 100
+
+
+def test_fill_holes_ignores_holes_of_removed_regions():
+    mask = np.zeros((60, 60), dtype=bool)
+    mask[10:15, 10:15] = True
+    mask[12, 12] = False  # 24 px ring
+
+    out = postprocess_mask(mask, fill_holes=True, min_area=30)
+
+    assert (out == 255).sum() == 0
+
+
+def test_dilate_and_erode():
+    grown = postprocess_mask(square_with_hole(), dilate=5)
+    assert grown[100, 45] == 255
+    assert grown[100, 44] == 0
+
+    shrunk = postprocess_mask(square_with_hole(), dilate=-5)
+    assert shrunk[100, 54] == 0
+    assert shrunk[100, 55] == 255
+
+
+def test_feather_ramps_edges():
+    out = postprocess_mask(square_with_hole(), feather=8)
+
+    edge = out[70, 40:60]
+    assert edge[0] == 0
+    assert edge[-1] == 255
+    assert np.all(np.diff(edge.astype(int)) >= 0)
+    assert 0 < out[70, 50] < 255
+
+
+def test_soft_mask_processed_in_place():
+    soft = np.zeros((200, 200), dtype=np.uint8)
+    soft[50:150, 50:150] = 200
+    soft[90:110, 90:110] = 40
+    soft[5:8, 5:8] = 200
+
+    out = postprocess_mask(soft, fill_holes=True, min_area=20)
+
+    assert out is soft
+    assert out[100, 100] == 255  # hole filled
+    assert np.all(out[90:110, 90:110] == 255)
+    assert out[60, 60] == 200  # matte values kept
+    assert out[89, 95] == 200  # rim around the hole kept
+    assert out[95, 89] == 200
+    assert out[110, 95] == 200
+    assert out[95, 110] == 200
+    assert out[6, 6] == 0  # island removed
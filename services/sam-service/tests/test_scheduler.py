@@ -0,0 +1,213 @@
+"""
+Tests for the priority scheduler
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from scheduler import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    PriorityScheduler,
+    QueueFullError,
+)
+
+
+def make_scheduler(max_queue=8, max_tenant=None, batch_defer_ms=0) -> PriorityScheduler:
+    return PriorityScheduler(
+        max_queue_depth={PRIORITY_INTERACTIVE: max_queue, PRIORITY_BATCH: max_queue},
+        batch_defer_ms=batch_defer_ms,
+        max_tenant_depth=max_tenant,
+    )
+
+
+def with_scheduler(**scheduler_args):
+    """Run an async test body against a started scheduler"""
+    def decorate(test):
+        def wrapper():
+            async def main():
+                scheduler = make_scheduler(**scheduler_args)
+                scheduler.start()
+                try:
+                    await test(scheduler)
+                finally:
+                    await scheduler.stop()
+
+            asyncio.run(main())
+        return wrapper
+    return decorate
+
+
+async def hold_worker(scheduler):
+    """Occupy the worker thread until the returned event is set"""
+    started, release = threading.Event(), threading.Event()
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    task = asyncio.create_task(scheduler.submit(blocker, PRIORITY_INTERACTIVE))
+    while not started.is_set():
+        await asyncio.sleep(0.001)
+    return release, task
+
+
+def recorder(order, name):
+    def job():
+        order.append(name)
+        return name
+    return job
+
+
+@with_scheduler()
+async def test_interactive_runs_before_batch(scheduler):
+    release, blocker = await hold_worker(scheduler)
+    order = []
+
+    batch = asyncio.create_task(scheduler.submit(recorder(order, "batch"), PRIORITY_BATCH))
+    interactive = asyncio.create_task(
+        scheduler.submit(recorder(order, "interactive"), PRIORITY_INTERACTIVE)
+    )
+    await asyncio.sleep(0.01)
+    release.set()
+
+    await asyncio.gather(blocker, batch, interactive)
+    assert order == ["interactive", "batch"]
+
+
+@with_scheduler()
+async def test_tenants_served_round_robin(scheduler):
+    release, blocker = await hold_worker(scheduler)
+    order = []
+
+    tasks = [
+        asyncio.create_task(scheduler.submit(recorder(order, name), PRIORITY_BATCH, tenant))
+        for name, tenant in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("b2", "b")]
+    ]
+    await asyncio.sleep(0.01)
+    release.set()
+
+    await asyncio.gather(blocker, *tasks)
+    assert order == ["a1", "b1", "a2", "b2", "a3"]
+
+
+@with_scheduler(max_queue=8, max_tenant={PRIORITY_BATCH: 2})
+async def test_tenant_over_its_cap_is_rejected(scheduler):
+    release, blocker = await hold_worker(scheduler)
+
+    queued = [
+        asyncio.create_task(scheduler.submit(lambda: None, PRIORITY_BATCH, "a"))
+        for _ in range(2)
+    ]
+    await asyncio.sleep(0)
+
+    with pytest.raises(QueueFullError) as error:
+        await scheduler.submit(lambda: None, PRIORITY_BATCH, "a")
+    assert error.value.tenant == "a"
+    assert error.value.limit == 2
+
+    # Another tenant is still admitted
+    other = asyncio.create_task(scheduler.submit(lambda: "b", PRIORITY_BATCH, "b"))
+    await asyncio.sleep(0)
+    release.set()
+
+    await asyncio.gather(blocker, *queued)
+    assert await other == "b"
+
+
+@with_scheduler(max_queue=3)
+async def test_full_class_sheds_heaviest_tenant(scheduler):
+    release, blocker = await hold_worker(scheduler)
+
+    heavy = [
+        asyncio.create_task(scheduler.submit(lambda i=i: i, PRIORITY_BATCH, "heavy"))
+        for i in range(3)
+    ]
+    await asyncio.sleep(0)
+
+    # The newest job of the heaviest tenant makes room for the light one
+    light = asyncio.create_task(scheduler.submit(lambda: "light", PRIORITY_BATCH, "light"))
+    await asyncio.sleep(0)
+    with pytest.raises(QueueFullError) as error:
+        await heavy[2]
+    assert error.value.tenant == "heavy"
+
+    # The heaviest tenant itself is rejected when the class is full
+    with pytest.raises(QueueFullError):
+        await scheduler.submit(lambda: None, PRIORITY_BATCH, "heavy")
+
+    release.set()
+    assert await asyncio.gather(heavy[0], heavy[1]) == [0, 1]
+    assert await light == "light"
+    await blocker
+
+
+@with_scheduler(max_queue=2)
+async def test_full_class_rejects_tenant_without_fewer_jobs(scheduler):
+    release, blocker = await hold_worker(scheduler)
+
+    queued = [
+        asyncio.create_task(scheduler.submit(lambda: None, PRIORITY_BATCH, tenant))
+        for tenant in ("a", "b")
+    ]
+    await asyncio.sleep(0)
+
+    with pytest.raises(QueueFullError) as error:
+        await scheduler.submit(lambda: None, PRIORITY_BATCH, "a")
+    assert error.value.tenant == "a"
+
+    release.set()
+    await asyncio.gather(blocker, *queued)
+
+
+@with_scheduler(batch_defer_ms=200)
+async def test_batch_deferred_after_interactive(scheduler):
+    finished = await scheduler.submit(time.monotonic, PRIORITY_INTERACTIVE)
+    started = await scheduler.submit(time.monotonic, PRIORITY_BATCH)
+
+    assert started - finished >= 0.15
+
+
+@with_scheduler()
+async def test_cancelled_job_is_dropped(scheduler):
+    release, blocker = await hold_worker(scheduler)
+    order = []
+
+    cancelled = asyncio.create_task(scheduler.submit(recorder(order, "cancelled"), PRIORITY_BATCH))
+    kept = asyncio.create_task(scheduler.submit(recorder(order, "kept"), PRIORITY_BATCH))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    release.set()
+
+    await asyncio.gather(blocker, kept)
+    assert order == ["kept"]
+    assert scheduler.stats()[PRIORITY_BATCH]["pending"] == 0
+
+
+@with_scheduler()
+async def test_checkpoint_runs_interactive_between_tiles(scheduler):
+    order = []
+    tile_started = threading.Event()
+    click_queued = threading.Event()
+
+    def tiled_job():
+        for tile in range(3):
+            if tile == 1:
+                tile_started.set()
+                click_queued.wait(5)
+            scheduler.checkpoint()
+            order.append(f"tile{tile}")
+
+    batch = asyncio.create_task(scheduler.submit(tiled_job, PRIORITY_BATCH))
+    while not tile_started.is_set():
+        await asyncio.sleep(0.001)
+
+    click = asyncio.create_task(scheduler.submit(recorder(order, "click"), PRIORITY_INTERACTIVE))
+    await asyncio.sleep(0)
+    click_queued.set()
+
+    await asyncio.gather(batch, click)
+    assert order == ["tile0", "click", "tile1", "tile2"]
@@ -0,0 +1,113 @@
+"""
+Tests for tiled high-resolution segmentation
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+from sam_model import SAMModel, _tile_spans
+
+
+class StubPredictor:
+    """Predicts every bright pixel of the current image as foreground"""
+
+    def __init__(self):
+        self.image = None
+        self.encoded = []
+
+    def set_image(self, image):
+        self.image = image
+        self.encoded.append(image.shape[:2])
+
+    def predict(self, point_coords=None, point_labels=None, box=None,
+                multimask_output=False, return_logits=False):
+        foreground = self.image[:, :, 0] > 127
+        if return_logits:
+            masks = np.where(foreground, 8.0, -8.0).astype(np.float32)[None]
+        else:
+            masks = foreground[None]
+        return masks, np.array([0.9]), None
+
+    def reset_image(self):
+        self.image = None
+
+
+class StubSAMModel(SAMModel):
+    def _load_model(self):
+        self.predictor = StubPredictor()
+
+
+def make_image(width=3000, height=2000):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[400:1700, 700:2600] = 255
+    return image
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_tile_spans_cover_region_exactly_once(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        limit = rng.randint(1, 5000)
+        start = rng.randrange(0, limit)
+        end = rng.randint(start + 1, limit)
+        tile = rng.randint(1, 2048)
+        overlap = rng.randrange(0, tile)
+
+        spans = _tile_spans(start, end, tile, overlap, limit)
+
+        assert spans[0][2] == start
+        assert spans[-1][3] == end
+        for (_, _, _, prev_own_end), (_, _, own_start, _) in zip(spans, spans[1:]):
+            assert own_start == prev_own_end
+        for tile_start, tile_end, own_start, own_end in spans:
+            assert 0 <= tile_start < tile_end <= limit
+            assert tile_end - tile_start == min(tile, limit)
+            assert tile_start <= own_start < own_end <= tile_end
+
+
+@pytest.mark.parametrize("tile_size, tile_overlap", [(0, 0), (-1, 0), (512, -1), (512, 512)])
+def test_invalid_tile_config_rejected(tile_size, tile_overlap):
+    with pytest.raises(ValueError):
+        StubSAMModel(device="cpu", tile_size=tile_size, tile_overlap=tile_overlap)
+
+
+def test_segment_tiled_matches_full_resolution_object():
+    model = StubSAMModel(device="cpu", tile_size=512, tile_overlap=64)
+    image = make_image()
+    calls = []
+
+    mask, score = model.segment_tiled(image, points=[[1500, 1000]], on_tile=lambda: calls.append(1))
+
+    assert mask.dtype == bool
+    assert np.array_equal(mask, image[:, :, 0] > 127)
+    assert score == pytest.approx(0.9)
+
+    # Coarse pass plus one encoder pass per tile, each at most one tile in size
+    tiles = model.predictor.encoded[1:]
+    assert len(calls) == len(tiles) > 1
+    assert all(h <= 512 and w <= 512 for h, w in tiles)
+    assert model.predictor.image is None
+
+
+def test_segment_tiled_soft_returns_alpha():
+    model = StubSAMModel(device="cpu", tile_size=512, tile_overlap=64)
+    image = make_image()
+
+    mask, _ = model.segment_tiled(image, box=(700, 400, 2600, 1700), soft=True)
+
+    assert mask.dtype == np.uint8
+    assert mask[1000, 1500] == 255
+    assert mask[1000, 100] == 0
+    assert np.array_equal(mask >= 128, image[:, :, 0] > 127)
+
+
+def test_segment_tiled_without_object_returns_empty_mask():
+    model = StubSAMModel(device="cpu", tile_size=512, tile_overlap=64)
+
+    mask, _ = model.segment_tiled(np.zeros((2000, 3000, 3), dtype=np.uint8), points=[[10, 10]])
+
+    assert mask.shape == (2000, 3000)
+    assert not mask.any()
+    assert len(model.predictor.encoded) == 1